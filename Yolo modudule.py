@@ -3,16 +3,30 @@ JSON to YOLO Format Converter
 Converts CholecT50 surgical action annotations to YOLO format
 """
 
-import json
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 import logging
 
+import numpy as np
+
+# Prefer a faster JSON parser when one is installed
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Pre-encoded "<class_id>\n" label lines for the usual (small) class ids
+_BYTES_CACHE = [f"{i}\n".encode() for i in range(256)]
+
 
 class JSONToYOLOConverter:
     """
@@ -30,15 +44,30 @@ class JSONToYOLOConverter:
             image_width: Width of images in pixels
             image_height: Height of images in pixels
         """
+        if image_width <= 0 or image_height <= 0:
+            raise ValueError(
+                f"Image dimensions must be positive, got {image_width}x{image_height}")
         self.image_width = image_width
         self.image_height = image_height
+        # Reciprocals so bbox normalization multiplies instead of divides
+        self._inv_w = 1.0 / image_width
+        self._inv_h = 1.0 / image_height
         self.categories = {}
         
     def load_json(self, json_path: str) -> Dict:
         """Load JSON annotation file."""
         try:
-            with open(json_path, 'r') as f:
-                data = json.load(f)
+            # Read the whole file in one call (unbuffered, raw bytes) and
+            # parse the contiguous buffer; orjson only accepts bytes anyway.
+            # The file is read front to back, so let the kernel prefetch.
+            with open(json_path, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    try:
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    except OSError:
+                        pass  # only a hint; e.g. ESPIPE on pipes
+                buf = f.read()
+            data = _json.loads(buf)
             logger.info(f"Loaded JSON: {json_path}")
             return data
         except Exception as e:
@@ -58,39 +87,77 @@ class JSONToYOLOConverter:
         x1, y1, bw, bh = bbox
         
         # Calculate center coordinates
-        x_center = (x1 + bw / 2) / self.image_width
-        y_center = (y1 + bh / 2) / self.image_height
+        x_center = (x1 + bw * 0.5) * self._inv_w
+        y_center = (y1 + bh * 0.5) * self._inv_h
         
         # Normalize width and height
-        width = bw / self.image_width
-        height = bh / self.image_height
+        width = bw * self._inv_w
+        height = bh * self._inv_h
         
         # Clip values to [0, 1]
-        x_center = max(0, min(1, x_center))
-        y_center = max(0, min(1, y_center))
-        width = max(0, min(1, width))
-        height = max(0, min(1, height))
+        x_center = max(0.0, min(1.0, x_center))
+        y_center = max(0.0, min(1.0, y_center))
+        width = max(0.0, min(1.0, width))
+        height = max(0.0, min(1.0, height))
         
         return x_center, y_center, width, height
     
+    def bboxes_to_yolo(self, bboxes: np.ndarray) -> np.ndarray:
+        """
+        Convert an array of bounding boxes to YOLO format in one pass.
+        
+        Args:
+            bboxes: (N, 4) array of [x1, y1, box_width, box_height], or a
+                single box of length 4
+            
+        Returns:
+            (N, 4) array of (x_center, y_center, width, height) normalized to [0, 1]
+        """
+        arr = np.array(bboxes, dtype=np.float64)
+        if arr.shape == (4,):
+            arr = arr.reshape(1, 4)
+        elif arr.ndim != 2 or arr.shape[1] != 4:
+            raise ValueError(f"Expected bboxes of shape (N, 4), got {arr.shape}")
+        
+        # Shift the corner to the box center
+        arr[:, 0] += arr[:, 2] * 0.5
+        arr[:, 1] += arr[:, 3] * 0.5
+        
+        # Normalize x/width and y/height columns
+        arr[:, 0::2] *= self._inv_w
+        arr[:, 1::2] *= self._inv_h
+        
+        # Clip values to [0, 1]
+        np.clip(arr, 0.0, 1.0, out=arr)
+        return arr
+    
     def extract_categories(self, json_data: Dict) -> Dict:
-        """Extract category mappings from JSON data."""
+        """Extract category mappings from JSON data (kept by reference, not copied)."""
         categories = json_data.get('categories', {})
         self.categories = categories
         return categories
     
-    def convert_frame_annotations(self, frame_annotations: List[List[int]]) -> List[str]:
-  
+    def convert_frame_annotations(self, frame_annotations: List[List[int]]) -> Optional[int]:
+        """Return the class of the first non-empty annotation (instrument id)."""
         for ann in frame_annotations:
             if len(ann) >= 1:
-                return [str(int(ann[0]))]  # instrument id as class
-        return []  # no label for this frame
+                return int(ann[0])  # instrument id as class
+        return None  # no label for this frame
 
 
     
     def convert_json_to_yolo(self, json_path: str, output_dir: str, 
-                         use_triplet_class: bool = False) -> None:
-
+                         use_triplet_class: bool = False, manifest: bool = False) -> None:
+        """
+        Convert one JSON annotation file to YOLO classification labels.
+        
+        Args:
+            json_path: Path to the JSON annotation file
+            output_dir: Directory to write labels to
+            use_triplet_class: Unused; kept for API compatibility
+            manifest: Write a single VID_{video}.tsv of tab-separated
+                "<frame> <class>" lines instead of one .txt file per frame
+        """
     # Load and prep
         json_data = self.load_json(json_path)
         self.extract_categories(json_data)
@@ -101,66 +168,115 @@ class JSONToYOLOConverter:
             return
 
         output_path = Path(output_dir)
-        output_path.mkdir(parents=True, exist_ok=True)
+        if not output_path.exists():
+            output_path.mkdir(parents=True, exist_ok=True)
 
         # Prefix: prefer JSON's "video", else fall back to file stem
         video_id = json_data.get('video', Path(json_path).stem)
 
-        # numeric-first sorting for frame keys
-        def _sort_key(k: str):
+        # numeric-first ordering: parse frame keys once so both groups sort
+        # with plain C-level comparisons (no key= callback). Keys int()
+        # accepts but isdecimal() rejects ("-2", " 7") still count as
+        # numeric, and the insertion index keeps "01"/"1" as two frames in
+        # their original order.
+        int_frames = []
+        str_frames = []
+        for i, (k, v) in enumerate(annotations.items()):
+            if k.isdecimal():
+                int_frames.append((int(k), i, v))
+                continue
             try:
-                return (0, int(k))
-            except Exception:
-                return (1, k)
+                int_frames.append((int(k), i, v))
+            except ValueError:
+                str_frames.append((k, v))
+        int_frames.sort()
+        str_frames.sort()
+        frames = [(fid, v) for fid, _, v in int_frames] + str_frames
+
+        # Constant per file; plain string concat beats Path / per frame
+        prefix = os.fspath(output_path) + os.sep + f"VID_{video_id}_"
 
         converted_count = 0
         skipped_empty = 0
+        manifest_buf = bytearray()
 
-        for frame_id in sorted(annotations.keys(), key=_sort_key):
-            frame_annotations = annotations[frame_id]
+        for frame_id, frame_annotations in frames:
 
             # Build the single-label (classification) line
-            yolo_lines = self.convert_frame_annotations(frame_annotations)
-            if not yolo_lines:
+            cls = self.convert_frame_annotations(frame_annotations)
+            if cls is None:
                 skipped_empty += 1
                 continue
 
-            # File name: VID##_{frame:06d}.txt, e.g., VID01_000048.txt
-            try:
-                fid = int(frame_id)
-                out_name = f"VID_{video_id}_{fid:06d}.txt"
-            except Exception:
-                out_name = f"VID_{video_id}_{frame_id}.txt"
+            line = _BYTES_CACHE[cls] if 0 <= cls < len(_BYTES_CACHE) else b"%d\n" % cls
+
+            if manifest:
+                # "<frame>\t<class>" line, written once after the loop
+                if isinstance(frame_id, int):
+                    manifest_buf += b"%06d\t" % frame_id
+                else:
+                    manifest_buf += f"{frame_id}\t".encode()
+                manifest_buf += line
+            else:
+                # File name: VID##_{frame:06d}.txt, e.g., VID01_000048.txt
+                if isinstance(frame_id, int):
+                    output_file = f"{prefix}{frame_id:06d}.txt"
+                else:
+                    output_file = f"{prefix}{frame_id}.txt"
 
-            output_file = output_path / out_name
-            with open(output_file, "w", encoding="utf-8") as f:
-                # classification: exactly one integer per file
-                f.write(yolo_lines[0].strip() + "\n")
+                # classification: exactly one integer per file; raw fd write
+                # skips the TextIOWrapper/BufferedWriter stack open() builds
+                fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
 
             converted_count += 1
 
+        if manifest:
+            # One file per video: O(1) syscalls instead of one file per frame
+            with open(os.path.join(output_dir, f"VID_{video_id}.tsv"), 'wb') as f:
+                f.write(manifest_buf)
+
         logger.info(f"{video_id}: converted {converted_count} frames; skipped {skipped_empty} empty.")
         logger.info(f"Output saved to: {output_dir}")
 
     
-    def batch_convert(self, json_files: List[str], output_base_dir: str) -> None:
+    def batch_convert(self, json_files: List[str], output_base_dir: str,
+                      max_workers: Optional[int] = None, manifest: bool = False) -> None:
         """
-        Convert multiple JSON files to YOLO format.
+        Convert multiple JSON files to YOLO format in parallel.
         
         Args:
             json_files: List of JSON file paths
-            output_base_dir: Base directory for outputs
+            output_base_dir: Directory for all label files; names carry the
+                VID_{video}_ prefix, so no per-video subdirectory is needed
+            max_workers: Number of worker processes (defaults to CPU count)
+            manifest: Write one VID_{video}.tsv per file instead of a label
+                file per frame
         """
-        for json_file in json_files:
-            json_path = Path(json_file)
-            video_name = json_path.stem
-            output_dir = os.path.join(output_base_dir, video_name)
-            
-            logger.info(f"Converting {json_file}...")
-            try:
-                self.convert_json_to_yolo(json_file, output_dir)
-            except Exception as e:
-                logger.error(f"Error converting {json_file}: {e}")
+        # Create the output directory once up front instead of per file
+        Path(output_base_dir).mkdir(parents=True, exist_ok=True)
+        
+        tasks = [(json_file, output_base_dir, self.image_width, self.image_height, manifest)
+                 for json_file in json_files]
+        
+        # Files are independent, so use worker processes (platform default
+        # start method); fall back to threads if a process pool can't be built
+        try:
+            ex = ProcessPoolExecutor(max_workers=max_workers)
+        except (ImportError, NotImplementedError, OSError):
+            ex = ThreadPoolExecutor(max_workers=max_workers)
+        
+        with ex:
+            results = list(ex.map(_convert_one, tasks))
+        
+        # Workers don't share state, so load categories once from the last
+        # file that converted (as a serial run would leave them)
+        converted = [f for f, ok in zip(json_files, results) if ok]
+        if converted:
+            self.extract_categories(self.load_json(converted[-1]))
     
     def create_class_mapping_file(self, output_path: str, 
                                    category_type: str = 'instrument') -> None:
@@ -200,25 +316,43 @@ class JSONToYOLOConverter:
             return
         
         categories = self.categories.get(category_type, {})
-        names = [categories[str(i)] for i in range(len(categories))]
         
-        yaml_content = f"""# Dataset configuration for YOLO
-        train: {train_path}
-        val: {val_path}
-
-        # Number of classes
-        nc: {len(categories)}
-
-        # Class names
-        names: {names}
-        """
+        # Class names ordered by id
+        names = tuple(categories[k] for k in sorted(categories, key=int))
         
-        with open(output_path, 'w') as f:
-            f.write(yaml_content)
+        # Built line by line so no source indentation leaks into the YAML
+        lines = [
+            "# Dataset configuration for YOLO\n",
+            f"train: {train_path}\n",
+            f"val: {val_path}\n",
+            "\n",
+            "# Number of classes\n",
+            f"nc: {len(categories)}\n",
+            "\n",
+            "# Class names\n",
+            f"names: {list(names)}\n",
+        ]
+        
+        with open(output_path, 'wb') as f:
+            f.write("".join(lines).encode())
         
         logger.info(f"YAML config saved to: {output_path}")
 
 
+def _convert_one(task: Tuple[str, str, int, int, bool]) -> bool:
+    """Convert a single JSON file in a worker; returns True on success."""
+    json_file, output_dir, image_width, image_height, manifest = task
+    converter = JSONToYOLOConverter(image_width=image_width, image_height=image_height)
+    
+    logger.info(f"Converting {json_file}...")
+    try:
+        converter.convert_json_to_yolo(json_file, output_dir, manifest=manifest)
+    except Exception as e:
+        logger.error(f"Error converting {json_file}: {e}")
+        return False
+    return True
+
+
 def main():
     """Batch convert all JSON files in a folder."""
     input_dir = "labels"        # <--- folder containing VID*.json
@@ -227,7 +361,10 @@ def main():
     converter = JSONToYOLOConverter(image_width=1920, image_height=1080)
 
     # gather all json files in folder
-    json_files = [str(p) for p in Path(input_dir).glob("*.json")]
+    json_files = []
+    if os.path.isdir(input_dir):
+        json_files = [e.path for e in os.scandir(input_dir)
+                      if e.is_file() and e.name.endswith(".json")]
 
     if not json_files:
         print("No json files found in", input_dir)